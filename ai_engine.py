@@ -1,89 +1,442 @@
 # httpx: 非同期HTTPリクエストを行うためのライブラリ。AI APIへの通信に使用します。
 import httpx
 import time
-import json
 import asyncio
+# anyio の to_thread.run_sync: 処理を別スレッドで実行します。FastAPI（Starlette）と同じスレッドプールと上限を使います。
+from anyio import to_thread
+import sqlite3
+import hashlib
+# re: 正規表現（文字列のパターン検索）を扱う標準ライブラリ
+import re
+# deque: 両端への追加・削除が高速なリスト。maxlenを指定すると、上限を超えた古い要素が自動で捨てられます。
+from collections import deque
+# orjson: C言語で実装された高速なJSONライブラリ。標準のjsonモジュールより速く変換できます。
+import orjson
+# msgspec: 型（構造）を指定してJSONを高速に読み込めるライブラリ。Ollamaの応答の解析に使用します。
+import msgspec
 from memory_mcp import memory_mcp_server
+# LLMの応答キャッシュは記憶とは別の、アプリ内部のデータなのでDBのモジュールを直接使います
+from database import get_llm_cache, put_llm_cache
 
 # 設定
-# ローカルで動作しているOllamaのAPIエンドポイント
-OLLAMA_API_URL = "http://localhost:11434/api/chat"
+# ローカルで動作しているOllamaサーバーのベースURL
+OLLAMA_BASE_URL = "http://localhost:11434"
+# OllamaのチャットAPIのパス（ベースURLからの相対パス）
+OLLAMA_CHAT_PATH = "/api/chat"
 # 使用するLLMのモデル名。Ollamaでpullしたモデルと一致させる必要があります。
 MODEL_NAME = "llama3.1:8b" # ユーザー指定のモデル
+# 記憶の整理（圧縮）処理で、Ollamaへ同時に送るリクエストの最大数
+# PROMPT_DESIGN.md の方針「Ollamaへ並列してリクエストしない」に従い、初期値は1（1件ずつ順番に送る）です。
+# Ollama側で並列処理を有効にしている（OLLAMA_NUM_PARALLEL を2以上にしている）環境に限り、
+# この値を増やすと、互いに関係のない統合・短縮の問い合わせを並行して送れます。
+OLLAMA_MAX_PARALLEL = 1
+# 記憶の整理処理でのLLM呼び出し1回あたりの最大待ち時間（秒）
+# httpxのタイムアウトは「データが届かない時間」に対するものなので、少しずつ応答が届き続けると終わりません。
+# asyncio.wait_for で呼び出し全体の時間にも上限を設け、Ollamaが固まっても処理が止まり続けないようにします。
+LLM_CALL_TIMEOUT = 180.0
+# 会話の分析（記憶の抽出）を後回しで実行するときの、待ち行列に溜められる最大件数
+# これを超えて依頼が溜まった場合は、新しい依頼を捨てて警告を表示します。
+ANALYSIS_QUEUE_SIZE = 100
+# 会話の分析を行うバックグラウンドワーカーの数
+# 「Ollamaへ並列してリクエストしない」方針のため、1つのワーカーが順番に処理します。
+ANALYSIS_WORKERS = 1
+# 会話履歴（短期記憶）として保持する最大メッセージ数（ユーザーとAIの発言を合わせて数えます）
+# 20件 = 直近10往復分。これより古い発言はLLMに送らないため、履歴が長くなってもプロンプトが増え続けません。
+HISTORY_MAX_MESSAGES = 20
+
+# 記憶として保存できる有効なカテゴリ
+# frozenset（変更不可の集合）にしておくと、呼び出しのたびにリストを作らずに済み、判定も高速です。
+_VALID_CATEGORIES = frozenset({"attribute", "goal", "memory", "request"})
+# 会話の区切りとみなす言葉
+# これらが入力に含まれていたら、短期記憶（会話履歴）をリセットします。
+_END_TOKENS = ("ありがとう", "さようなら")
+
+# 記憶の抽出（LLM呼び出し）を省略するかどうかを判定するための正規表現
+# re.compile で一度だけ変換しておき、毎回のパターン解析を省きます。
+# 相づちと記号だけでできた入力（例: 「はい」「OK」「うん。」「そうですね！」）に一致するパターン
+# 記憶すべき内容があるかどうかの判定はLLMに任せるため（PROMPT_DESIGN.md）、ここでは明らかな相づちだけを除きます。
+_TRIVIAL_INPUT_RE = re.compile(
+    r"(?:はい|いいえ|うん|ううん|ええ|そう|そうですね|そうだね|なるほど|了解|りょうかい|ok|笑|w|ｗ"
+    r"|[ー。、.,!！?？~〜\s])+",
+    re.IGNORECASE,
+)
+
+# Ollamaと通信するための共有HTTPクライアント
+# リクエストのたびに httpx.AsyncClient() を作ると、毎回TCP接続の確立と
+# コネクションプールの作成が発生して無駄が大きくなります。
+# モジュール全体で1つのクライアントを使い回すことで、接続を再利用（keep-alive）できます。
+# 最初に必要になったとき（_get_client()）に作ります。close_client() で閉じた後は None に戻し、
+# もう一度アプリケーションを起動したとき（テストで TestClient を作り直したときなど）に作り直します。
+_CLIENT = None
+
+# 共有HTTPクライアントを取得する関数
+# まだ作っていない場合や、閉じられている場合は新しく作ります。
+# limits: 同時接続数の上限と、待機中（keep-alive）で保持しておく接続数の上限
+def _get_client():
+    global _CLIENT
+    if _CLIENT is None or _CLIENT.is_closed:
+        _CLIENT = httpx.AsyncClient(
+            base_url=OLLAMA_BASE_URL,
+            timeout=httpx.Timeout(120.0),
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        )
+    return _CLIENT
+
+# Ollamaの応答（JSON）の形を定義するクラス
+# msgspec.Struct を継承すると、JSONを辞書を経由せずに直接このクラスのオブジェクトへ変換できます。
+# 定義していない項目（model, created_at など）は読み飛ばされるので、必要な部分だけを取り出せます。
+# 応答の message 部分（content: AIの応答テキスト）
+class OllamaMessage(msgspec.Struct):
+    content: str = ""
+
+# 応答全体（message が無い場合は空のメッセージとして扱います）
+class OllamaResponse(msgspec.Struct):
+    message: OllamaMessage = msgspec.field(default_factory=OllamaMessage)
+
+# エラー時の応答（例: {"error": "model not found"}）
+class OllamaErrorResponse(msgspec.Struct):
+    error: str = ""
+
+# Ollamaの応答（バイト列または1行分の文字列）から、AIの応答テキストを取り出す関数
+# response.json() のように一度Pythonの辞書を作ってから取り出すのではなく、
+# msgspecでバイト列から直接 OllamaResponse に変換するので、余計な変換が発生しません。
+def _reply_text(body):
+    return msgspec.json.decode(body, type=OllamaResponse).message.content
+
+# Ollamaのエラー応答から、エラーメッセージを取り出す関数
+# 想定した形（{"error": ...}）でない場合は、応答の本文をそのまま返します。
+def _error_text(body):
+    try:
+        return msgspec.json.decode(body, type=OllamaErrorResponse).error or body.decode(errors="replace")
+    except msgspec.DecodeError:
+        return body.decode(errors="replace")
+
+# 共有HTTPクライアントを閉じる関数
+# アプリケーション終了時（FastAPIのシャットダウン時）に呼び出して、接続を解放します。
+async def close_client():
+    global _CLIENT
+    if _CLIENT is not None:
+        await _CLIENT.aclose()
+        _CLIENT = None
+
+# システムプロンプト（固定部分）
+# AIに対する「役割」や「振る舞い」を定義する最も重要な指示です。
+# 記憶の内容を含めず毎回同じ文字列にすることで、プロンプトの先頭が変わらないようにします。
+SYSTEM_STATIC = """あなたは優秀なAI秘書です。
+ユーザーの入力に対して、続けて渡す記憶の情報を踏まえて適切に応答してください。
+自然な日本語で答えてください。"""
+
+# プロンプトのテンプレート
+# 毎回 f文字列で組み立てる代わりに、固定部分をモジュールの定数として一度だけ用意しておきます。
+# 呼び出し時は format_map で {名前} の部分だけを差し込みます。
+# JSONの例に含まれる波かっこは、差し込み用の {} と区別するために {{ }} と2つ重ねて書いています。
+
+# 会話から記憶すべき情報を抽出するためのプロンプト（{user_text}: ユーザーの入力）
+_EXTRACT_TMPL = """
+以下のユーザーの入力から、長期的に保存すべきユーザーの情報（属性、目標、記憶、アシスタントへの要望）を抽出してください。
+保存すべき情報がない場合は、"items": [] としてください。
+JSON形式のみで出力してください。Markdownのコードブロックは不要です。
+
+重要: 以下の「フォーマット例」に記載されている内容（プログラマーである、Pythonをマスターしたい等）は、あくまで形式の例です。
+実際の入力に含まれていない限り、絶対に出力に含めないでください。
+
+フォーマット例:
+{{
+    "items": [
+        {{ "category": "attribute", "content": "ユーザーはプログラマーである" }},
+        {{ "category": "goal", "content": "ユーザーはPythonをマスターしたい" }},
+        {{ "category": "request", "content": "返答は短くしてほしい" }}
+    ]
+}}
+
+有効なカテゴリ: attribute (属性), goal (目標), memory (一般記憶), request (要望)
+
+[ユーザーの入力]
+{user_text}
+"""
+
+# 類似・重複した記憶のグループを探すためのプロンプト（{items_json}: 記憶リストのJSON）
+_SIM_TMPL = """
+以下の記憶リストから、意味が重複している、または非常に似ている項目のグループを探してください。
+グループがない場合は空のリストを返してください。
+
+リスト:
+{items_json}
+
+出力フォーマット(JSON):
+{{
+    "groups": [
+        [ID1, ID2],
+        [ID3, ID4, ID5]
+    ]
+}}
+"""
+
+# 複数の記憶を1つの文に統合するためのプロンプト（{contents}: 統合する記憶の箇条書き）
+_MERGE_TMPL = """
+以下の複数の情報を、意味を損なわない範囲で最も単純で明確な一つの文にまとめてください。
+
+{contents}
+
+出力は統合後の文のみを返してください。JSON不要。
+"""
+
+# 矛盾する記憶のペアを探すためのプロンプト（{items_json}: 作成日時付きの記憶リストのJSON）
+_CONTRA_TMPL = """
+以下の記憶リストの中に、論理的に矛盾する（両立しない）項目のペアはありますか？
+矛盾がある場合、作成日時（created_at）が古い方のIDを指摘してください。
+
+リスト:
+{items_json}
+
+出力フォーマット(JSON):
+{{
+    "contradictions": [
+        {{ "ids": [ID1, ID2], "reason": "矛盾の理由", "older_id": ID1 }}
+    ]
+}}
+矛盾がない場合は "contradictions": []
+"""
+
+# 統合・矛盾・短縮の3つの分析を1回でまとめて行うためのプロンプト
+# （{items_json}: 作成日時付きの記憶リストのJSON / {long_items_json}: 短縮の対象となる長い記憶のJSON）
+_FUSED_TMPL = """
+以下の記憶リストについて、次の3つの作業をまとめて行ってください。
+
+1. groups: 意味が重複している、または非常に似ている項目のグループを探し、グループごとに
+   意味を損なわない範囲で最も単純で明確な一つの文（merged）にまとめてください。
+2. contradictions: 論理的に矛盾する（両立しない）項目のペアを探し、作成日時（created_at）が古い方のIDを指摘してください。
+3. shortens: 「短縮対象リスト」の各文を、意味を損なわない範囲でできるだけ短くシンプルに書き直してください。
+   元の文の意味が完全に保たれる場合のみ含めてください。
+
+該当するものがない作業は、空のリストを返してください。
+
+記憶リスト:
+{items_json}
+
+短縮対象リスト:
+{long_items_json}
+
+出力フォーマット(JSON):
+{{
+    "groups": [
+        {{ "ids": [ID1, ID2], "merged": "統合後の文" }}
+    ],
+    "contradictions": [
+        {{ "ids": [ID3, ID4], "reason": "矛盾の理由", "older_id": ID3 }}
+    ],
+    "shortens": [
+        {{ "id": ID5, "shorter": "短く書き直した文" }}
+    ]
+}}
+"""
+
+# 長い記憶を短く書き直すためのプロンプト（{content}: 元の文）
+_SHORTEN_TMPL = """
+以下の文を、意味を損なわない範囲でできるだけ短くシンプルに書き直してください。
+元の文の意味が完全に保たれる場合のみ変更してください。
+
+文: {content}
+
+出力は書き直した文のみ。
+"""
+
+# 記憶の整理処理の進捗を、画面へ送る1行分のデータ（NDJSON）に変換する関数
+# orjsonで直接バイト列を作り、改行を付けて返します。
+# バイト列のまま返すと、FastAPIのStreamingResponseは文字列からの変換をせずにそのまま送信します。
+def _emit(step, message):
+    return orjson.dumps({"step": step, "message": message}) + b"\n"
+
+# LLM呼び出しのヘルパーで「失敗」として扱う例外
+# httpx.HTTPError: 通信エラーやOllamaのエラー応答 / asyncio.TimeoutError: 時間切れ
+# msgspec.DecodeError: 応答の形が想定外 / ValueError: JSONの解析エラー（orjson.JSONDecodeErrorを含む）
+# sqlite3.Error: 応答キャッシュの読み書きの失敗
+_LLM_CALL_ERRORS = (httpx.HTTPError, asyncio.TimeoutError, msgspec.DecodeError, ValueError, sqlite3.Error)
+
+# LLMの応答キャッシュのキーを作る関数
+# モデル名・JSONモードかどうか・プロンプトの組み合わせをハッシュ化し、16バイトの値にします。
+# どれか1つでも違えば別のキーになるので、モデルを変えたときに古い応答が使われることはありません。
+def _llm_cache_key(prompt, json_mode):
+    raw = f"{MODEL_NAME}\0{'json' if json_mode else 'text'}\0{prompt}"
+    return hashlib.blake2b(raw.encode(), digest_size=16).digest()
+
+# 一括分析（_FUSED_TMPL）の結果が期待した形になっているかを確認する関数
+# groups / contradictions / shortens の3つがそろい、それぞれリストになっている場合のみ True を返します。
+def _is_fused_result(result):
+    return isinstance(result, dict) and all(
+        isinstance(result.get(key), list) for key in ("groups", "contradictions", "shortens")
+    )
+
+# LLMの応答をキャッシュ（llm_cacheテーブル）に保存してよいかを判定する関数
+# 空の応答、JSONモードで壊れたJSON、cache_if の判定に合わない応答は保存しません。
+def _is_cacheable(content, json_mode, cache_if):
+    if not content.strip():
+        return False
+    if not json_mode:
+        return cache_if is None or bool(cache_if(content))
+    try:
+        parsed = orjson.loads(content)
+    except orjson.JSONDecodeError:
+        return False
+    return cache_if is None or bool(cache_if(parsed))
+
+# 記憶ブロックに並べるカテゴリの順番と見出し
+# (read_resourceの結果のキー, プロンプトに表示する見出し) の組を、固定の順番で並べます。
+MEMORY_SECTIONS = (
+    ("attributes", "ユーザーの属性"),
+    ("goals", "ユーザーの目標"),
+    ("requests", "アシスタントへのお願い"),
+    ("memories", "その他の記憶"),
+)
+
+# 記憶ブロック（システムプロンプトの記憶部分）を組み立てる関数
+# 同じ記憶からは必ず同じ文字列ができるように、各カテゴリ内をidの昇順で並べます。
+# idは追加順に増えるので、記憶が1件追加されてもそのカテゴリの末尾に1行増えるだけになり、
+# それより前の部分は前回と同じ文字列のまま保たれます。
+# 末尾にはブロック全体のハッシュ値（バージョン）を付け、テストモードでキャッシュが
+# 効いているか（記憶が前回と同じか）を確認しやすくしています。
+def _build_memory_block(formatted_memories):
+    sections = []
+    for key, title in MEMORY_SECTIONS:
+        items = sorted(formatted_memories[key], key=lambda m: m["id"])
+        lines = "\n".join(f"- {m['content']}" for m in items) or "（なし）"
+        sections.append(f"[{title}]\n{lines}")
+    block = "\n\n".join(sections)
+    # blake2b: 高速なハッシュ関数。digest_size=4 で8文字の短い値にします。
+    version = hashlib.blake2b(block.encode(), digest_size=4).hexdigest()
+    return f"{block}\n\n[記憶バージョン: {version}]"
 
 class AIEngine:
     def __init__(self):
-        # 会話履歴を保持するリスト。短期記憶として機能します。
-        self.history = []
+        # 会話履歴を保持するキュー（deque）。短期記憶として機能します。
+        # 上限（HISTORY_MAX_MESSAGES）を超えると、最も古い発言から自動的に捨てられます。
+        self.history = deque(maxlen=HISTORY_MAX_MESSAGES)
         # 最後にインタラクション（会話）があった時刻を記録します。
         self.last_interaction_time = 0
         self.conversation_active = False
-
-    # AIとのチャットを行うメインのメソッド
+        # 会話の分析依頼（ユーザーの入力）を溜めておく待ち行列
+        # チャットの応答を返した後に、バックグラウンドのワーカーが順番に取り出して分析します。
+        self._bg_queue = asyncio.Queue(maxsize=ANALYSIS_QUEUE_SIZE)
+        # 起動したワーカーのタスク
+        # 参照を持っておかないと、実行中のタスクがガベージコレクションで消えてしまうことがあるため保持します。
+        self._bg_workers = []
+        # 前回作った記憶ブロックのキャッシュ (元にした記憶の辞書, 記憶ブロックの文字列)
+        # MCPサーバーは記憶が書き換わるまで同じ辞書オブジェクトを返すので、同じなら作り直しません。
+        self._memory_block_cache = (None, None)
+        # Ollamaへ同時に送るリクエストの数を制限するセマフォ（エンジン全体で1つ）
+        # チャットの応答、バックグラウンドの会話分析、記憶の整理のどれからの呼び出しも、このセマフォを通します。
+        # OLLAMA_MAX_PARALLEL=1（初期値）なら、PROMPT_DESIGN.md の「Ollamaへ並列してリクエストしない」の通り、
+        # 常に1件ずつ順番にOllamaへ送られます。
+        self._ollama_sem = asyncio.Semaphore(OLLAMA_MAX_PARALLEL)
+
+    # バックグラウンドワーカーを起動するメソッド
+    # asyncio のタスクはイベントループが動いている中でしか作れないため、
+    # __init__ ではなく最初に分析を依頼したときに起動します。
+    def _ensure_workers(self):
+        if not self._bg_workers:
+            self._bg_workers = [asyncio.create_task(self._bg_worker()) for _ in range(ANALYSIS_WORKERS)]
+
+    # バックグラウンドワーカー本体
+    # 待ち行列から分析依頼を1件ずつ取り出して analyze_and_save を実行し続けます。
+    # 1件の分析で例外が起きても、ログを表示して次の依頼の処理を続けます。
+    async def _bg_worker(self):
+        while True:
+            user_text = await self._bg_queue.get()
+            try:
+                await self.analyze_and_save(user_text)
+            except Exception as e:
+                print(f"Background analysis failed: {e}")
+            finally:
+                self._bg_queue.task_done()
+
+    # バックグラウンドワーカーを停止するメソッド
+    # アプリケーション終了時に呼び出します。
+    async def shutdown(self):
+        for task in self._bg_workers:
+            task.cancel()
+        await asyncio.gather(*self._bg_workers, return_exceptions=True)
+        self._bg_workers = []
+
+    # AIとのチャットを行うメインのメソッド（一括で結果を返す版）
     # async キーワードにより、この関数は非同期関数となり、awaitで実行待ちができます。
+    # 中身は chat_stream() と同じ処理で、最後の結果（step: done）だけを取り出して返します。
     async def chat(self, user_input: str, test_mode: bool = False):
+        async for event in self.chat_stream(user_input, test_mode):
+            if event["step"] == "done":
+                return {"response": event["response"], "debug_info": event["debug_info"]}
+
+    # AIとのチャットを行うメソッド（ストリーミング版）
+    # 応答の生成が全て終わるのを待たずに、生成された文字を少しずつ yield で返します。
+    # ユーザーは最初の文字が届いた時点から応答を読み始められるので、待ち時間が短く感じられます。
+    # yield する値:
+    #   {"step": "delta", "content": 追加で生成された文字列}  （応答の途中経過、何度も届く）
+    #   {"step": "done", "response": 応答全文, "debug_info": {...}}  （最後に1回だけ届く）
+    async def chat_stream(self, user_input: str, test_mode: bool = False):
         current_time = time.time()
         
         # セッション管理: コンテキストのリセット判定
         # 「最後の会話から5分経過」している場合、過去の履歴（短期記憶）を忘れます。
         # 人間同様、しばらく時間が経つと直前の話題を忘れる挙動を模倣しています。
         if (current_time - self.last_interaction_time > 300):
-            self.history = []
+            self.history.clear()
             self.conversation_active = False
         
         self.last_interaction_time = current_time
         
         # 1. コンテキスト（長期記憶）の取得 - MCP経由に変更
         # MCPサーバーからリソースを取得します。
-        formatted_memories = memory_mcp_server.read_resource("memories://active")
+        # SQLiteの読み込みは待ち時間が発生する（ブロッキングする）処理なので、to_thread.run_sync で
+        # 別スレッドで実行します。その間もイベントループは他のリクエストの処理を続けられます。
+        formatted_memories = await to_thread.run_sync(memory_mcp_server.read_resource, "memories://active")
         
-        attributes = [m['content'] for m in formatted_memories["attributes"]]
-        goals = [m['content'] for m in formatted_memories["goals"]]
-        requests = [m['content'] for m in formatted_memories["requests"]]
-        memory_list = [m['content'] for m in formatted_memories["memories"]]
-        
-        # システムプロンプトの構築
-        # AIに対する「役割」や「振る舞い」を定義する最も重要な指示です。
-        # MCPから取得した記憶（コンテキスト）をここに埋め込みます。
-        system_prompt = f"""
-あなたは優秀なAI秘書です。
-ユーザーの入力に対して、以下の情報を踏まえて適切に応答してください。
-自然な日本語で答えてください。
-
-[ユーザーの属性]
-{json.dumps(attributes, ensure_ascii=False)}
-
-[ユーザーの目標]
-{json.dumps(goals, ensure_ascii=False)}
-
-[アシスタントへのお願い]
-{json.dumps(requests, ensure_ascii=False)}
-
-[その他の記憶]
-{json.dumps(memory_list, ensure_ascii=False)}
-"""
+        # 記憶ブロックの構築
+        # MCPから取得した記憶（コンテキスト）を、固定の指示とは別のメッセージにまとめます。
+        cached_source, memory_block = self._memory_block_cache
+        if cached_source is not formatted_memories:
+            memory_block = _build_memory_block(formatted_memories)
+            self._memory_block_cache = (formatted_memories, memory_block)
 
         # AIに送るメッセージリストを作成
-        # system: AIの設定
+        # system(1つ目): AIの役割・振る舞い（毎回まったく同じ文字列）
+        # system(2つ目): 長期記憶のブロック
         # user/assistant: 過去の会話履歴
         # user: 今回の入力
-        messages = [{"role": "system", "content": system_prompt}] + self.history + [{"role": "user", "content": user_input}]
+        # 先頭のメッセージを毎回同じにしておくと、Ollama（llama.cpp）が前回計算した
+        # プロンプト先頭部分の結果（KVキャッシュ）を再利用でき、応答開始までの時間が短くなります。
+        messages = [
+            {"role": "system", "content": SYSTEM_STATIC},
+            {"role": "system", "content": memory_block},
+        ] + list(self.history) + [{"role": "user", "content": user_input}]
         
-        # 2. Ollama APIの呼び出し
+        # 2. Ollama APIの呼び出し（ストリーミング）
+        # stream: True にすると、Ollamaは生成した文字を1行ずつのJSONとして少しずつ送ってきます。
+        # 受け取った断片は pieces に貯めておき、最後に連結して履歴に保存します。
+        pieces = []
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(OLLAMA_API_URL, json={
+            # 他のOllama呼び出し（会話分析や記憶の整理）が終わるのを待ってから送信します
+            async with self._ollama_sem:
+                # 共有クライアントを使うため、URLはベースURLからの相対パスで指定します
+                # _get_client().stream(...) は、応答の本文を全部読み込まずに、届いた分から順に読める形で返します。
+                async with _get_client().stream("POST", OLLAMA_CHAT_PATH, json={
                     "model": MODEL_NAME,
                     "messages": messages,
-                    "stream": False # ストリーム機能は今回は使わず、一括で返答を受け取ります
-                }, timeout=60.0) # タイムアウトを60秒に設定
+                    "stream": True
+                }, timeout=60.0) as response: # タイムアウトを60秒に設定
                 
-                if response.status_code != 200:
-                    result_text = f"エラーが発生しました: {response.text}"
-                else:
-                    data = response.json()
-                    # レスポンスJSONから、AIの応答テキストを取り出します
-                    result_text = data.get("message", {}).get("content", "")
+                    if response.status_code != 200:
+                        await response.aread() # エラー内容を表示するため、本文を最後まで読み込みます
+                        result_text = f"エラーが発生しました: {_error_text(response.content)}"
+                    else:
+                        # aiter_lines(): 届いたデータを1行ずつ取り出します（1行 = 1つのJSON）
+                        async for line in response.aiter_lines():
+                            if not line:
+                                continue
+                            # 各行をOllamaResponseとして直接読み込み、今回生成された文字を取り出します
+                            delta = _reply_text(line)
+                            if delta:
+                                pieces.append(delta)
+                                yield {"step": "delta", "content": delta}
+                        result_text = "".join(pieces)
 
         except Exception as e:
             result_text = f"通信エラー: {str(e)}"
@@ -93,18 +446,30 @@ class AIEngine:
         self.history.append({"role": "assistant", "content": result_text})
         
         # 特定のキーワードに対する処理
-        # 「ありがとう」と言われたら、区切りとみなして履歴をリセットします。
-        if "ありがとう" in user_input:
-            self.history = [] # 履歴のクリア
+        # 「ありがとう」「さようなら」と言われたら、区切りとみなして履歴をリセットします。
+        if any(token in user_input for token in _END_TOKENS):
+            self.history.clear() # 履歴のクリア
             self.conversation_active = False
         else:
             self.conversation_active = True
 
-        # 4. バックグラウンドタスクの実行 -> 変更: テストモードでログを表示するためAwaitします
+        # 4. 会話の分析（記憶の抽出）
+        # テストモードでは分析ログを画面に表示するため、分析の完了を待ちます（Await）。
+        # 通常モードでは待ち行列に入れるだけにして、ユーザーが応答を読んでいる間に
+        # バックグラウンドのワーカーが分析します。
         # analysis_log: { "prompt": str, "response": str }
-        analysis_log = await self.analyze_and_save(user_input)
+        analysis_log = None
+        if test_mode:
+            analysis_log = await self.analyze_and_save(user_input)
+        else:
+            self._ensure_workers()
+            try:
+                self._bg_queue.put_nowait(user_input)
+            except asyncio.QueueFull:
+                print("Analysis queue is full; dropping analysis request")
         
-        return {
+        yield {
+            "step": "done",
             "response": result_text,
             "debug_info": {
                 "chat_messages": messages, # 送信した全メッセージ（システムプロンプト含む）
@@ -117,61 +482,44 @@ class AIEngine:
         # 情報を抽出するための専用プロンプト
         # JSON形式での出力を強制することで、プログラムでの処理を容易にします。
         # AIの応答は含めず、ユーザーの発言のみを対象とします。
-        prompt = f"""
-以下のユーザーの入力から、長期的に保存すべきユーザーの情報（属性、目標、記憶、アシスタントへの要望）を抽出してください。
-保存すべき情報がない場合は、"items": [] としてください。
-JSON形式のみで出力してください。Markdownのコードブロックは不要です。
-
-重要: 以下の「フォーマット例」に記載されている内容（プログラマーである、Pythonをマスターしたい等）は、あくまで形式の例です。
-実際の入力に含まれていない限り、絶対に出力に含めないでください。
-
-フォーマット例:
-{{
-    "items": [
-        {{ "category": "attribute", "content": "ユーザーはプログラマーである" }},
-        {{ "category": "goal", "content": "ユーザーはPythonをマスターしたい" }},
-        {{ "category": "request", "content": "返答は短くしてほしい" }}
-    ]
-}}
-
-有効なカテゴリ: attribute (属性), goal (目標), memory (一般記憶), request (要望)
-
-[ユーザーの入力]
-{user_text}
-"""
+        # 事前チェック: 空の入力や、相づち・記号だけの入力は、LLMを呼ばずに終了します
+        # LLMによる分析は時間がかかるため、「はい」「OK」のような入力で毎回呼び出すのは無駄になります。
+        # それ以外の入力は、記憶すべき内容があるかどうかをLLMが判定します。
+        text = user_text.strip()
+        if not text or _TRIVIAL_INPUT_RE.fullmatch(text):
+            return {"prompt": "", "response": "", "parsed": None, "skipped": "相づちや記号だけの入力のため、分析を省略しました"}
+
+        prompt = _EXTRACT_TMPL.format_map({"user_text": user_text})
         result_log = {"prompt": prompt, "response": "", "parsed": None}
 
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(OLLAMA_API_URL, json={
-                    "model": MODEL_NAME,
-                    "messages": [{"role": "user", "content": prompt}],
-                    "format": "json", # OllamaのJSONモードを有効化（モデルが対応している場合）
-                    "stream": False
-                }, timeout=60.0)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    content = data.get("message", {}).get("content", "")
-                    result_log["response"] = content
-                    try:
-                        # 文字列としてのJSONをPythonの辞書オブジェクトに変換
-                        parsed = json.loads(content)
-                        result_log["parsed"] = parsed
-                        if "items" in parsed and isinstance(parsed["items"], list):
-                            for item in parsed["items"]:
-                                category = item.get("category")
-                                content_str = item.get("content")
-                                if category and content_str:
-                                    # 有効なカテゴリかチェックしてからデータベースに保存
-                                    if category in ['attribute', 'goal', 'memory', 'request']:
-                                        # MCP経由で保存（Tool call）
-                                        memory_mcp_server.call_tool("add_memory", {"category": category, "content": content_str})
-                    except json.JSONDecodeError:
-                        print("Failed to parse JSON from analysis")
-                        result_log["error"] = "Failed to parse JSON from analysis"
-                else:
-                    result_log["error"] = f"LLM error: {response.text}"
+            # JSONモードでLLMに問い合わせます（同じ入力を以前に分析していれば、キャッシュから結果を取得します）
+            content = await self._ask_llm(prompt, json_mode=True, timeout=60.0)
+            result_log["response"] = content
+            try:
+                # 文字列としてのJSONをPythonの辞書オブジェクトに変換
+                parsed = orjson.loads(content)
+                result_log["parsed"] = parsed
+                if "items" in parsed and isinstance(parsed["items"], list):
+                    # 有効な項目だけを集めて、最後に1回でまとめて保存します
+                    new_items = []
+                    for item in parsed["items"]:
+                        category = item.get("category")
+                        content_str = item.get("content")
+                        if category and content_str:
+                            # 有効なカテゴリかチェックしてから保存対象に加えます
+                            if category in _VALID_CATEGORIES:
+                                new_items.append({"category": category, "content": content_str})
+                    if new_items:
+                        # MCP経由で保存（Tool call）。リストを渡すと1つのトランザクションでまとめて追加されます。
+                        # DBへの書き込みは別スレッドで実行します。
+                        await to_thread.run_sync(memory_mcp_server.call_tool, "add_memory", new_items)
+            except orjson.JSONDecodeError:
+                print("Failed to parse JSON from analysis")
+                result_log["error"] = "Failed to parse JSON from analysis"
+        except httpx.HTTPStatusError as e:
+            # Ollamaがエラー（200以外）を返した場合
+            result_log["error"] = f"LLM error: {_error_text(e.response.content)}"
         except Exception as e:
             print(f"Analysis failed: {e}")
             result_log["error"] = str(e)
@@ -181,176 +529,299 @@ JSON形式のみで出力してください。Markdownのコードブロック
     # 記憶の圧縮・統合を行うメソッド（ストリーミング版）
     # ステップバイステップで実行し、ログをyieldで返します。
     async def compress_memories_stream(self):
-        import datetime
-        
-        yield json.dumps({"step": "start", "message": "記憶の整理プロセスを開始します..."}) + "\n"
+        yield _emit("start", "記憶の整理プロセスを開始します...")
         
         # 1. 全記憶の取得 (MCP経由)
-        memories = memory_mcp_server.read_resource("memories://all")
+        memories = await to_thread.run_sync(memory_mcp_server.read_resource, "memories://all")
         if not memories:
-            yield json.dumps({"step": "end", "message": "記憶がありません。終了します。"}) + "\n"
+            yield _emit("end", "記憶がありません。終了します。")
             return
 
         # カテゴリごとに処理
+        # 最初に1回だけ全記憶をカテゴリごとに振り分けておきます（カテゴリの数だけリスト全体を見直さないため）
         categories = ['attribute', 'goal', 'request', 'memory']
+        by_category = {category: [] for category in categories}
+        for m in memories:
+            if m['category'] in by_category:
+                by_category[m['category']].append(m)
+
+        # LLMにテキストを問い合わせる関数
+        # 同時にOllamaへ送る数は、_ask_llm の中のエンジン全体のセマフォで OLLAMA_MAX_PARALLEL 件までに制限されます。
+        ask_text = self._call_llm_text
         
         for category in categories:
-            cat_memories = [m for m in memories if m['category'] == category]
+            cat_memories = by_category[category]
             if not cat_memories:
                 continue
-            
-            yield json.dumps({"step": "category_start", "message": f"\n--- カテゴリ: {category} ({len(cat_memories)}件) の整理を開始 ---"}) + "\n"
 
-            # ---------------------------------------------------------
-            # 3.1 & 3.2: 重複/類似の意味を持つ情報の統合
-            # ---------------------------------------------------------
-            yield json.dumps({"step": "process", "message": "類似した意味を持つ記憶を探索中..."}) + "\n"
-            
-            # リストをJSON化
-            items_json = json.dumps([{"id": m["id"], "content": m["content"]} for m in cat_memories], ensure_ascii=False)
-            
-            prompt_similarity = f"""
-以下の記憶リストから、意味が重複している、または非常に似ている項目のグループを探してください。
-グループがない場合は空のリストを返してください。
-
-リスト:
-{items_json}
-
-出力フォーマット(JSON):
-{{
-    "groups": [
-        [ID1, ID2],
-        [ID3, ID4, ID5]
-    ]
-}}
-"""
-            groups = await self._call_llm_json(prompt_similarity)
+            # このカテゴリで行うDB操作（追加・削除・更新）を貯めておくリスト
+            # カテゴリの整理が終わった時点で、まとめて1回で書き込みます。
+            ops = []
             
-            if groups and "groups" in groups and groups["groups"]:
-                for group_ids in groups["groups"]:
-                    if len(group_ids) < 2: continue
-                    
-                    # 該当する記憶の内容を取得
-                    targets = [m for m in cat_memories if m["id"] in group_ids]
-                    if len(targets) < 2: continue
-                    
-                    yield json.dumps({"step": "action", "message": f"類似項目を統合します: {[t['content'] for t in targets]}"}) + "\n"
-                    
-                    # 統合プロンプト
-                    contents = "\n".join([f"- {t['content']}" for t in targets])
-                    prompt_merge = f"""
-以下の複数の情報を、意味を損なわない範囲で最も単純で明確な一つの文にまとめてください。
-
-{contents}
-
-出力は統合後の文のみを返してください。JSON不要。
-"""
-                    merged_content = await self._call_llm_text(prompt_merge)
-                    
-                    # DB更新 (MCP経由)
-                    # 古いものを削除
-                    for t in targets:
-                        memory_mcp_server.call_tool("delete_memory", {"id": t["id"]})
-                        # ローカルリストからも削除（以降の処理のため）
-                        cat_memories = [m for m in cat_memories if m["id"] != t["id"]]
-
-                    # 新しいものを追加
-                    memory_mcp_server.call_tool("add_memory", {"category": category, "content": merged_content})
-                    yield json.dumps({"step": "result", "message": f"統合完了 -> {merged_content}"}) + "\n"
+            yield _emit("category_start", f"\n--- カテゴリ: {category} ({len(cat_memories)}件) の整理を開始 ---")
+
+            # 統合・矛盾・短縮の3つの分析を、1回のLLM呼び出しでまとめて行います。
+            # 別々に3回問い合わせると、その度に記憶リスト全体をLLMに読み込ませる（プリフィル）必要がありますが、
+            # まとめれば読み込みは1回で済みます。
+            yield _emit("process", "統合・矛盾・短縮の候補をまとめて分析中...")
+            items_json = orjson.dumps([{"id": m["id"], "content": m["content"], "created_at": m["created_at"]} for m in cat_memories]).decode()
+            # 短縮の対象は15文字より長い記憶だけに絞って渡します
+            long_items_json = orjson.dumps([{"id": m["id"], "content": m["content"]} for m in cat_memories if len(m["content"]) > 15]).decode()
+            # 期待する形（_is_fused_result）の応答だけをキャッシュし、形が違った場合は次回もう一度まとめて問い合わせます
+            fused = await self._call_llm_json(
+                _FUSED_TMPL.format_map({"items_json": items_json, "long_items_json": long_items_json}),
+                cache_if=_is_fused_result,
+            )
+
+            if _is_fused_result(fused):
+                steps = self._apply_fused_result(category, cat_memories, fused, ops, ask_text)
             else:
-                yield json.dumps({"step": "info", "message": "統合すべき類似項目はありませんでした。"}) + "\n"
-
-            # ---------------------------------------------------------
-            # 3.4: 矛盾する内容の整合性チェック
-            # ---------------------------------------------------------
-            # リロード（統合で変わったため）
-            # ここでは簡易的に、現在の cat_memories を見直すのではなく、再度読み込むのが安全だがパフォーマンス上省略し、
-            # 残っているものでチェックします。
-            
-            if len(cat_memories) >= 2:
-                yield json.dumps({"step": "process", "message": "矛盾する内容の探索中..."}) + "\n"
-                items_json = json.dumps([{"id": m["id"], "content": m["content"], "created_at": m["created_at"]} for m in cat_memories], ensure_ascii=False)
+                # 期待した形のJSONが返ってこなかった場合は、従来どおり1つずつ問い合わせる方法に切り替えます
+                yield _emit("info", "まとめての分析に失敗したため、項目ごとに分析します。")
+                steps = self._compress_category_steps(category, cat_memories, ops, ask_text)
+            async for frame in steps:
+                yield frame
+
+            # このカテゴリのDB操作をまとめて反映 (MCP経由)
+            # 1回のスレッド切り替え・1回のトランザクションで全ての変更を書き込みます。
+            await to_thread.run_sync(memory_mcp_server.call_tool, "batch_apply", {"ops": ops})
+
+        yield _emit("complete", "全ての整理プロセスが完了しました。")
+
+    # 一括分析（_FUSED_TMPL）の結果を使って、1つのカテゴリの記憶を整理するメソッド
+    # 統合・矛盾・短縮の判断は1回の分析結果から取り出し、行うDB操作を ops に追加していきます。
+    # 統合後の文が結果に含まれていないグループだけ、個別にLLMへ統合を依頼します。
+    async def _apply_fused_result(self, category, cat_memories, fused, ops, ask_text):
+        # ---------------------------------------------------------
+        # 3.1 & 3.2: 重複/類似の意味を持つ情報の統合
+        # ---------------------------------------------------------
+        merge_groups = []
+        merged_contents = []
+        for group in fused["groups"]:
+            if not isinstance(group, dict): continue
+            group_ids = group.get("ids")
+            if not isinstance(group_ids, list): continue
+            # 該当する記憶の内容を取得（他のグループで統合済みのものは除く）
+            targets = [m for m in cat_memories if m["id"] in group_ids]
+            if len(targets) < 2: continue
+
+            yield _emit("action", f"類似項目を統合します: {[t['content'] for t in targets]}")
+            merge_groups.append(targets)
+            merged = group.get("merged")
+            merged_contents.append(merged.strip() if isinstance(merged, str) and merged.strip() else None)
+            # ローカルリストからも削除（以降の処理のため）
+            target_ids = {t["id"] for t in targets}
+            cat_memories = [m for m in cat_memories if m["id"] not in target_ids]
+
+        if not merge_groups:
+            yield _emit("info", "統合すべき類似項目はありませんでした。")
+
+        # 統合後の文が無いグループは、個別に統合を依頼します（同時に送る数は OLLAMA_MAX_PARALLEL まで）
+        missing = [i for i, merged in enumerate(merged_contents) if merged is None]
+        results = await asyncio.gather(*(
+            ask_text(_MERGE_TMPL.format_map({"contents": "\n".join([f"- {t['content']}" for t in merge_groups[i]])}))
+            for i in missing
+        ))
+        for i, merged in zip(missing, results):
+            merged_contents[i] = merged
+
+        for targets, merged_content in zip(merge_groups, merged_contents):
+            # 統合後の文が得られなかった（空の応答やエラーの）場合は、元の記憶を消さずに残します
+            if not merged_content or not merged_content.strip():
+                yield _emit("info", "統合後の文を取得できなかったため、元の記憶をそのまま残します。")
+                continue
+            for t in targets:
+                ops.append(("delete", (t["id"],)))
+            ops.append(("add", (category, merged_content)))
+            yield _emit("result", f"統合完了 -> {merged_content}")
+
+        # ---------------------------------------------------------
+        # 3.4: 矛盾する内容の整合性チェック
+        # ---------------------------------------------------------
+        found = False
+        for cont in fused["contradictions"]:
+            if not isinstance(cont, dict): continue
+            older_id = cont.get("older_id")
+            target = next((m for m in cat_memories if m["id"] == older_id), None)
+            if target:
+                found = True
+                yield _emit("action", f"矛盾を検出 ({cont.get('reason')})。古い記憶を削除: {target['content']}")
+                ops.append(("delete", (older_id,)))
+                cat_memories = [m for m in cat_memories if m["id"] != older_id]
+        if not found:
+            yield _emit("info", "矛盾点は見つかりませんでした。")
+
+        # ---------------------------------------------------------
+        # 3.3: 長い文章の短縮
+        # ---------------------------------------------------------
+        for item in fused["shortens"]:
+            if not isinstance(item, dict): continue
+            m = next((m for m in cat_memories if m["id"] == item.get("id")), None)
+            shortened = item.get("shorter")
+            if not m or not isinstance(shortened, str) or len(m["content"]) <= 15:
+                continue
+            shortened = shortened.strip()
+            # 空の応答（エラーなど）で記憶の内容を消してしまわないように、空の場合は何もしません
+            if shortened and len(shortened) < len(m["content"]) and shortened != m["content"]:
+                yield _emit("action", f"短縮: {m['content']} -> {shortened}")
+                ops.append(("update", (shortened, category, m["id"])))
+
+    # 1つのカテゴリの記憶を、統合・矛盾・短縮の順に個別のLLM呼び出しで整理するメソッド
+    # 一括分析の結果が使えなかったときの予備の方法です。行うDB操作を ops に追加していきます。
+    async def _compress_category_steps(self, category, cat_memories, ops, ask_text):
+        # ---------------------------------------------------------
+        # 3.1 & 3.2: 重複/類似の意味を持つ情報の統合
+        # ---------------------------------------------------------
+        yield _emit("process", "類似した意味を持つ記憶を探索中...")
+        
+        # リストをJSON化
+        # orjsonは日本語をそのまま（エスケープせずに）出力し、結果はバイト列なので decode() で文字列にします
+        items_json = orjson.dumps([{"id": m["id"], "content": m["content"]} for m in cat_memories]).decode()
+        
+        prompt_similarity = _SIM_TMPL.format_map({"items_json": items_json})
+        groups = await self._call_llm_json(prompt_similarity)
+        
+        if groups and "groups" in groups and groups["groups"]:
+            # 統合するグループを先に確定させます（同じ記憶が複数のグループに入らないように順番に取り除く）
+            merge_groups = []
+            for group_ids in groups["groups"]:
+                if len(group_ids) < 2: continue
                 
-                prompt_contradiction = f"""
-以下の記憶リストの中に、論理的に矛盾する（両立しない）項目のペアはありますか？
-矛盾がある場合、作成日時（created_at）が古い方のIDを指摘してください。
-
-リスト:
-{items_json}
-
-出力フォーマット(JSON):
-{{
-    "contradictions": [
-        {{ "ids": [ID1, ID2], "reason": "矛盾の理由", "older_id": ID1 }}
-    ]
-}}
-矛盾がない場合は "contradictions": []
-"""
-                contradictions = await self._call_llm_json(prompt_contradiction)
+                # 該当する記憶の内容を取得
+                targets = [m for m in cat_memories if m["id"] in group_ids]
+                if len(targets) < 2: continue
                 
-                if contradictions and "contradictions" in contradictions and contradictions["contradictions"]:
-                    for cont in contradictions["contradictions"]:
-                        older_id = cont.get("older_id")
-                        if older_id:
-                            target = next((m for m in cat_memories if m["id"] == older_id), None)
-                            if target:
-                                yield json.dumps({"step": "action", "message": f"矛盾を検出 ({cont.get('reason')})。古い記憶を削除: {target['content']}"}) + "\n"
-                                memory_mcp_server.call_tool("delete_memory", {"id": older_id})
-                                cat_memories = [m for m in cat_memories if m["id"] != older_id]
-                else:
-                    yield json.dumps({"step": "info", "message": "矛盾点は見つかりませんでした。"}) + "\n"
-
-            # ---------------------------------------------------------
-            # 3.3: 長い文章の短縮
-            # ---------------------------------------------------------
-            yield json.dumps({"step": "process", "message": "長い文章の短縮チェック中..."}) + "\n"
-            for m in cat_memories:
-                if len(m["content"]) > 15:
-                    prompt_shorten = f"""
-以下の文を、意味を損なわない範囲でできるだけ短くシンプルに書き直してください。
-元の文の意味が完全に保たれる場合のみ変更してください。
-
-文: {m['content']}
-
-出力は書き直した文のみ。
-"""
-                    shortened = await self._call_llm_text(prompt_shorten)
-                    shortened = shortened.strip()
-                    
-                    if len(shortened) < len(m["content"]) and shortened != m["content"]:
-                         yield json.dumps({"step": "action", "message": f"短縮: {m['content']} -> {shortened}"}) + "\n"
-                         memory_mcp_server.call_tool("update_memory", {"id": m["id"], "content": shortened, "category": category})
-
-        yield json.dumps({"step": "complete", "message": "全ての整理プロセスが完了しました。"}) + "\n"
+                yield _emit("action", f"類似項目を統合します: {[t['content'] for t in targets]}")
+                merge_groups.append(targets)
+                # ローカルリストからも削除（以降の処理のため）
+                target_ids = {t["id"] for t in targets}
+                cat_memories = [m for m in cat_memories if m["id"] not in target_ids]
+
+            # 統合プロンプトを作成します
+            merge_prompts = []
+            for targets in merge_groups:
+                contents = "\n".join([f"- {t['content']}" for t in targets])
+                merge_prompts.append(_MERGE_TMPL.format_map({"contents": contents}))
+            # グループごとの統合は互いに関係がないので、asyncio.gather でまとめて実行します。
+            # 同時にOllamaへ送る数は、エンジン全体のセマフォで OLLAMA_MAX_PARALLEL 件（初期値1）までに制限されます。
+            # 結果は merge_prompts と同じ順番のリストで返ってきます。
+            merged_contents = await asyncio.gather(*(ask_text(p) for p in merge_prompts))
+            
+            for targets, merged_content in zip(merge_groups, merged_contents):
+                # 統合後の文が得られなかった（空の応答やエラーの）場合は、元の記憶を消さずに残します
+                if not merged_content or not merged_content.strip():
+                    yield _emit("info", "統合後の文を取得できなかったため、元の記憶をそのまま残します。")
+                    continue
+                # DB更新（カテゴリの最後にまとめて実行）
+                # 古いものを削除
+                for t in targets:
+                    ops.append(("delete", (t["id"],)))
+
+                # 新しいものを追加
+                ops.append(("add", (category, merged_content)))
+                yield _emit("result", f"統合完了 -> {merged_content}")
+        else:
+            yield _emit("info", "統合すべき類似項目はありませんでした。")
+
+        # ---------------------------------------------------------
+        # 3.4: 矛盾する内容の整合性チェック
+        # ---------------------------------------------------------
+        # リロード（統合で変わったため）
+        # ここでは簡易的に、現在の cat_memories を見直すのではなく、再度読み込むのが安全だがパフォーマンス上省略し、
+        # 残っているものでチェックします。
+        
+        if len(cat_memories) >= 2:
+            yield _emit("process", "矛盾する内容の探索中...")
+            items_json = orjson.dumps([{"id": m["id"], "content": m["content"], "created_at": m["created_at"]} for m in cat_memories]).decode()
+            
+            prompt_contradiction = _CONTRA_TMPL.format_map({"items_json": items_json})
+            contradictions = await self._call_llm_json(prompt_contradiction)
+            
+            if contradictions and "contradictions" in contradictions and contradictions["contradictions"]:
+                for cont in contradictions["contradictions"]:
+                    older_id = cont.get("older_id")
+                    if older_id:
+                        target = next((m for m in cat_memories if m["id"] == older_id), None)
+                        if target:
+                            yield _emit("action", f"矛盾を検出 ({cont.get('reason')})。古い記憶を削除: {target['content']}")
+                            ops.append(("delete", (older_id,)))
+                            cat_memories = [m for m in cat_memories if m["id"] != older_id]
+            else:
+                yield _emit("info", "矛盾点は見つかりませんでした。")
+
+        # ---------------------------------------------------------
+        # 3.3: 長い文章の短縮
+        # ---------------------------------------------------------
+        yield _emit("process", "長い文章の短縮チェック中...")
+        # 短縮の対象（15文字より長い記憶）
+        candidates = [m for m in cat_memories if len(m["content"]) > 15]
+
+        # 1件分の短縮を問い合わせる関数
+        async def shorten(m):
+            prompt_shorten = _SHORTEN_TMPL.format_map({"content": m["content"]})
+            return (await ask_text(prompt_shorten)).strip()
+
+        # 全ての短縮をまとめて問い合わせます（同時に送る数は OLLAMA_MAX_PARALLEL まで）
+        shortened_list = await asyncio.gather(*(shorten(m) for m in candidates))
+        for m, shortened in zip(candidates, shortened_list):
+            # 空の応答（エラーなど）で記憶の内容を消してしまわないように、空の場合は何もしません
+            if shortened and len(shortened) < len(m["content"]) and shortened != m["content"]:
+                 yield _emit("action", f"短縮: {m['content']} -> {shortened}")
+                 ops.append(("update", (shortened, category, m["id"])))
+
+    # ヘルパー: LLMに1回問い合わせて、応答テキストを返す
+    # json_mode=True の場合は、OllamaのJSONモードで問い合わせます。
+    # 同じプロンプトへの応答はDB（llm_cacheテーブル）に保存しておき、次回はLLMを呼ばずにそれを返します。
+    # Ollamaがエラーを返した場合は httpx.HTTPStatusError が発生します。
+    # total_timeout: Ollamaへの送信から応答を受け取るまでの合計時間の上限（秒）。None なら上限なし。
+    #                セマフォの順番待ちの時間は含めないので、他の呼び出しの後ろで待っている間に時間切れになりません。
+    # cache_if: 応答をキャッシュしてよいかを判定する関数（JSONモードでは変換後の値、それ以外は文字列を受け取ります）。
+    #           呼び出し側が期待する形でない応答を保存して、7日間使い回してしまわないようにします。
+    #           キャッシュから取り出した応答にも同じ判定を行い、合わないものは使わずに問い合わせ直します。
+    async def _ask_llm(self, prompt, json_mode=False, timeout=120.0, total_timeout=None, cache_if=None):
+        key = _llm_cache_key(prompt, json_mode)
+        cached = await to_thread.run_sync(get_llm_cache, key)
+        if cached is not None and _is_cacheable(cached, json_mode, cache_if):
+            return cached
+
+        payload = {
+            "model": MODEL_NAME,
+            "messages": [{"role": "user", "content": prompt}],
+            "stream": False
+        }
+        if json_mode:
+            payload["format"] = "json" # OllamaのJSONモードを有効化（モデルが対応している場合）
+        # 他のOllama呼び出し（チャットの応答など）と同時に送らないように、エンジン全体のセマフォを通します
+        async with self._ollama_sem:
+            response = await asyncio.wait_for(
+                _get_client().post(OLLAMA_CHAT_PATH, json=payload, timeout=timeout), total_timeout
+            )
+        # 200以外の応答なら例外を発生させます
+        response.raise_for_status()
+        content = _reply_text(response.content)
+
+        # 空の応答や壊れたJSON、呼び出し側が期待しない形の応答は、次回に問い合わせ直せるようにキャッシュしません
+        if _is_cacheable(content, json_mode, cache_if):
+            await to_thread.run_sync(put_llm_cache, key, content)
+        return content
 
     # ヘルパー: LLMを呼んでJSONを返す
-    async def _call_llm_json(self, prompt):
+    # 通信エラー・タイムアウト・JSONの解析エラーの場合は、警告を表示して空の辞書を返します。
+    # それ以外の例外（プログラムの誤りや、キャンセル asyncio.CancelledError など）はそのまま呼び出し元へ伝えます。
+    # cache_if: _ask_llm と同じ（応答をキャッシュしてよいかを判定する関数）
+    async def _call_llm_json(self, prompt, cache_if=None):
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(OLLAMA_API_URL, json={
-                    "model": MODEL_NAME,
-                    "messages": [{"role": "user", "content": prompt}],
-                    "format": "json",
-                    "stream": False
-                }, timeout=120.0)
-                if response.status_code == 200:
-                    return json.loads(response.json().get("message", {}).get("content", "{}"))
-        except:
+            content = await self._ask_llm(prompt, json_mode=True, total_timeout=LLM_CALL_TIMEOUT, cache_if=cache_if)
+            return orjson.loads(content or "{}")
+        except _LLM_CALL_ERRORS as e:
+            print(f"LLM call failed: {e!r}")
             return {}
-        return {}
 
     # ヘルパー: LLMを呼んでテキストを返す
+    # 失敗した場合の扱いは _call_llm_json と同じで、空文字を返します。
     async def _call_llm_text(self, prompt):
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(OLLAMA_API_URL, json={
-                    "model": MODEL_NAME,
-                    "messages": [{"role": "user", "content": prompt}],
-                    "stream": False
-                }, timeout=120.0)
-                if response.status_code == 200:
-                    return response.json().get("message", {}).get("content", "")
-        except:
+            return await self._ask_llm(prompt, total_timeout=LLM_CALL_TIMEOUT)
+        except _LLM_CALL_ERRORS as e:
+            print(f"LLM call failed: {e!r}")
             return ""
-        return ""
-
@@ -1,93 +1,430 @@
+import os
 import sqlite3
-from datetime import datetime
+import threading
+import time
+import queue
+from collections import OrderedDict
+from itertools import groupby
+from operator import itemgetter
+from contextlib import contextmanager
 
 # データベースファイルの名前
 # このファイルに全ての記憶が保存されます。アプリケーションと同じフォルダに作成されます。
-DB_FILE = "memory_assistant.db"
-
-# データベース接続を取得するヘルパー関数
-# sqlite3.connect() でデータベースに接続します。
-def get_db_connection():
-    conn = sqlite3.connect(DB_FILE)
-    # Rowファクトリを設定することで、カラム名でデータにアクセスできるようになります。
-    # 例: row['category'] のようにアクセス可能（辞書のように扱える）
-    conn.row_factory = sqlite3.Row
+# 起動したときのカレントディレクトリに関係なく同じファイルを開くように、このファイルの場所を基準にした絶対パスにします。
+DB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "memory_assistant.db")
+
+# LLMの応答キャッシュの有効期限（秒）。7日より古い応答は使わずに、LLMへ問い合わせ直します。
+LLM_CACHE_TTL = 7 * 24 * 60 * 60
+
+# 読み込み結果のキャッシュ（プロセス内で保持）
+# チャットのたびに同じSELECTを実行しなくて済むように、前回の結果を覚えておきます。
+# キー: (種類, 引数, バージョン) の組  例: ("all", "goal", 3) / ("bucketed", 10, 3)
+# 値: その時点の検索結果
+# OrderedDict は追加・利用の順番を覚えているので、一番古い（最近使われていない）ものから捨てられます（LRU方式）。
+_CACHE = OrderedDict()
+# キャッシュに保持する検索結果の最大数。これを超えると最近使われていないものから削除します。
+_CACHE_MAX = 32
+# 書き込みのたびに1ずつ増える番号（記憶が変わったかどうかの目印）
+# キーにバージョンを含めるので、書き込み後は古い結果が使われなくなります。
+_version = 0
+# キャッシュを複数のスレッドから同時に書き換えないためのロック
+_CACHE_LOCK = threading.Lock()
+
+# キャッシュを無効化する関数
+# 記憶を追加・更新・削除する関数の最後で必ず呼び出します。
+# 次回の読み込み時には、SQLを実行して最新の内容を取得し直します。
+def _bump():
+    global _version
+    with _CACHE_LOCK:
+        _version += 1
+        _CACHE.clear() # 古いバージョンの結果は二度と使われないので、まとめて捨てます
+
+# 現在のキャッシュのバージョンを返す関数
+# 呼び出し側（memory_mcp など）が、自分で作った加工結果をバージョンごとにキャッシュするときに使います。
+def cache_version():
+    with _CACHE_LOCK:
+        return _version
+
+# キャッシュから検索結果を取り出す関数
+# 見つかった場合は (結果, バージョン)、なければ (None, バージョン) を返します。
+# 返したバージョンは、SQLを実行した後に _cache_put() へそのまま渡します。
+def _cache_get(kind, arg):
+    with _CACHE_LOCK:
+        key = (kind, arg, _version)
+        value = _CACHE.get(key)
+        if value is not None:
+            _CACHE.move_to_end(key) # 最近使ったものとして末尾に移動します
+        return value, _version
+
+# 検索結果をキャッシュに保存する関数
+# version: SQLを実行する前に _cache_get() で受け取ったバージョン
+# 読み込み中に他の書き込みがあった場合はバージョンが変わっているので、古い結果は保存しません。
+def _cache_put(kind, arg, version, value):
+    with _CACHE_LOCK:
+        if version != _version:
+            return
+        _CACHE[(kind, arg, version)] = value
+        if len(_CACHE) > _CACHE_MAX:
+            _CACHE.popitem(last=False) # 一番古いものを削除します
+
+# 読み込み用のコネクションプールに用意しておく接続の最大数（CPUのコア数まで、最大8）
+# SQLite（WALモード）は、読み込みは同時にいくつでも実行できますが、書き込みは同時に1つだけです。
+# そのため読み込み用は複数の接続を、書き込み用は1つの接続だけを用意します。
+READ_POOL_SIZE = min(8, os.cpu_count() or 1)
+
+# このモジュールで実行するSQL文
+# 関数の中に直接書かずに定数にしておくことで、どの関数からも同じ文字列を使うようにします。
+# Pythonのsqlite3は、同じ文字列のSQLを実行すると、接続ごとのキャッシュ（初期設定で128文）から
+# コンパイル済みの文を再利用します。プールで接続を使い回し、SQLを毎回同じ文字列で渡すことで、
+# 接続ごとのSQLの解析を最初の1回だけにします。
+_SQL_INSERT = 'INSERT INTO memories (category, content) VALUES (?, ?)'
+_SQL_SELECT_ALL = 'SELECT id, category, content, created_at FROM memories ORDER BY created_at DESC'
+_SQL_SELECT_BY_CATEGORY = 'SELECT id, category, content, created_at FROM memories WHERE category = ? ORDER BY created_at DESC'
+# LIMIT ? OFFSET ?: 先頭から offset 件を飛ばして、limit 件だけ取得します（-1 は件数の制限なし）
+_SQL_SELECT_PAGE = 'SELECT id, category, content, created_at FROM memories ORDER BY created_at DESC LIMIT ? OFFSET ?'
+_SQL_SELECT_PAGE_BY_CATEGORY = 'SELECT id, category, content, created_at FROM memories WHERE category = ? ORDER BY created_at DESC LIMIT ? OFFSET ?'
+_SQL_UPDATE = 'UPDATE memories SET content = ?, category = ? WHERE id = ?'
+_SQL_DELETE = 'DELETE FROM memories WHERE id = ?'
+# このモジュールが必要とするSQLiteのバージョン（RETURNING 句が使えるのは 3.35 以降）
+# Python に同梱されている SQLite のバージョンは sqlite3.sqlite_version で確認できます。
+MIN_SQLITE_VERSION = (3, 35, 0)
+
+# RETURNING: 書き込んだ行の内容を、同じSQLの結果として受け取ります（SQLite 3.35以降）。
+# 書き込んだ後にもう一度SELECTして読み直す必要がなくなります。
+# （executemany では結果を受け取れないため、まとめて実行する処理には上のSQLを使います）
+_SQL_INSERT_RETURNING = _SQL_INSERT + ' RETURNING id, category, content, created_at'
+_SQL_UPDATE_RETURNING = _SQL_UPDATE + ' RETURNING id, category, content, created_at'
+_SQL_DELETE_RETURNING = _SQL_DELETE + ' RETURNING id'
+_SQL_DELETE_ALL = 'DELETE FROM memories'
+# カテゴリごとに新しい順の連番を振り、上位k件だけをカテゴリ順に並べて取り出すSQL（get_memories_bucketed 用）
+_SQL_TOPK_BY_CATEGORY = '''
+    SELECT id, category, content, created_at FROM (
+        SELECT *, ROW_NUMBER() OVER (
+            PARTITION BY category ORDER BY created_at DESC, id DESC
+        ) AS rank
+        FROM memories
+    )
+    WHERE rank <= ?
+    ORDER BY category, created_at DESC, id DESC
+'''
+_SQL_LLM_CACHE_GET = 'SELECT resp FROM llm_cache WHERE key = ? AND ts >= ?'
+_SQL_LLM_CACHE_TOUCH = 'UPDATE llm_cache SET ts = ? WHERE key = ?'
+_SQL_LLM_CACHE_PUT = 'INSERT OR REPLACE INTO llm_cache (key, resp, ts) VALUES (?, ?, ?)'
+_SQL_LLM_CACHE_SWEEP = 'DELETE FROM llm_cache WHERE ts < ?'
+
+# 記憶を取得するSQLが返す列の名前（SELECT文の列の順番と同じにします）
+_MEMORY_KEYS = ('id', 'category', 'content', 'created_at')
+
+# 検索結果のタプルのリストを、列名をキーにした辞書のリストに変換する関数
+# sqlite3.Row を dict() で変換するより、決まった列名のタプルと zip する方が1行あたりの処理が少なくなります。
+def _to_dicts(rows):
+    keys = _MEMORY_KEYS
+    return [dict(zip(keys, row)) for row in rows]
+
+# データベース接続を1つ作る関数
+# プールが新しい接続を必要としたときに呼び出します。
+# query_only=True: 読み込み専用の接続にします（誤って書き込むとエラーになります）。
+def _connect(query_only=False):
+    # isolation_level=None: 自動コミットモード。1文ごとに自動で確定されるので commit() が不要になります。
+    # check_same_thread=False: 作成したスレッド以外からの利用を許可します（プールで使い回すため）。
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    # row_factory は設定せず、検索結果は軽いタプルのまま受け取ります。
+    # 辞書への変換は _to_dicts() で、列名のタプルと zip してまとめて行います。
+    # 高速化のための設定（PRAGMA）
+    # これらの設定は接続ごとに有効なので、プールが作る全ての接続に設定します。
+    # （journal_mode=WAL はファイルに保存される設定なので、init_db() で1回だけ設定します）
+    # synchronous=NORMAL: WALモードで安全に使える範囲で、ディスクへの強制書き込み(fsync)を減らします。
+    # cache_size: 接続ごとのページキャッシュの大きさ（マイナスの値はKB単位の指定。約20MB）。
+    # temp_store=MEMORY: 一時的なデータ（並べ替えなど）をメモリ上で扱います。
+    # mmap_size: データベースファイルをメモリにマップして読み込みを速くします（256MB）。
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    if query_only:
+        conn.execute("PRAGMA query_only=TRUE")
     return conn
 
+# データベース接続のプール（使い回すための置き場）
+# 処理のたびに接続→切断すると、接続の確立や、接続ごとに持っているページキャッシュの破棄が毎回発生します。
+# 一度作った接続をここに戻して次の処理で再利用することで、キャッシュを温かいまま保てます。
+# 同時に貸し出す接続の数は size 個までに制限し、それ以上の利用者は空くまで待ちます。
+# query_only: True の場合、読み込み専用の接続だけを作ります。
+class ConnectionPool:
+    def __init__(self, size, query_only=False):
+        self._query_only = query_only
+        # 空いている接続の置き場。LIFO（後入れ先出し）にして、直近に使った接続から再利用します。
+        self._idle = queue.LifoQueue()
+        # 同時に貸し出せる接続数を制限するセマフォ
+        self._slots = threading.BoundedSemaphore(size)
+
+    # 接続を1つ借りて、withブロックを抜けたら返すメソッド
+    # 使い方: with pool.connection() as conn: conn.execute(...)
+    @contextmanager
+    def connection(self):
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = _connect(self._query_only) # 空きがなければ新しく作ります
+            try:
+                yield conn
+            finally:
+                self._idle.put(conn)
+
+    # プール内の全ての接続を閉じるメソッド（アプリケーション終了時に使用）
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+# アプリケーション全体で共有するコネクションプール
+# _read_pool: SELECT 用（読み込み専用の接続を複数）
+# _write_pool: INSERT / UPDATE / DELETE 用（接続は1つだけ。書き込みはここで順番待ちになります）
+_read_pool = ConnectionPool(READ_POOL_SIZE, query_only=True)
+_write_pool = ConnectionPool(1)
+
+# 読み込み用のデータベース接続を取得するヘルパー関数
+# プールから接続を借り、withブロックを抜けると自動でプールに返します。
+# 書き込みを待たずに、他の読み込みと同時に実行できます。
+# 使い方: with get_read_connection() as conn: conn.execute(...)
+def get_read_connection():
+    return _read_pool.connection()
+
+# 書き込み用のデータベース接続を取得するヘルパー関数
+# withブロック全体を BEGIN IMMEDIATE〜COMMIT の1つのトランザクションにします。
+# IMMEDIATE: 開始時点で書き込みのロックを取るので、途中で他の書き込みと競合して失敗することがありません。
+# ブロックの途中でエラーが起きた場合は ROLLBACK して、全ての操作をなかったことにします。
+# 使い方: with get_write_connection() as conn: conn.execute(...)
+@contextmanager
+def get_write_connection():
+    with _write_pool.connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+# データベース接続を全て閉じる関数
+# アプリケーション終了時（FastAPIのシャットダウン時）に呼び出します。
+def close_db():
+    _read_pool.close()
+    _write_pool.close()
+
 # データベースの初期化関数
 # テーブルが存在しない場合に作成（CREATE TABLE）します。
 def init_db():
-    conn = get_db_connection()
-    c = conn.cursor()
-    # SQLを実行してテーブルを作成
-    # IF NOT EXISTS: すでにテーブルがある場合は何もしない
-    # id: 一意な識別子 (PRIMARY KEY)
-    # category: 記憶の種類（属性、目標、記憶、要望）
-    # content: 記憶の内容
-    # created_at: 作成日時（デフォルトで現在時刻を入れる）
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS memories (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            category TEXT NOT NULL, -- attribute, goal, memory, request
-            content TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    # 古いSQLiteでは RETURNING 句が構文エラーになり、記憶の追加・更新が毎回失敗するため、起動時に確認します
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        required = ".".join(map(str, MIN_SQLITE_VERSION))
+        raise RuntimeError(
+            f"SQLite {required} 以降が必要です（現在: {sqlite3.sqlite_version}）。"
+            "より新しいPythonを使用するか、SQLiteを更新してください。"
         )
-    ''')
-    conn.commit() # 変更を確定
-    conn.close()  # 接続を閉じる
+    # journal_mode はトランザクションの中では変更できないため、ここでは書き込み用の接続をそのまま使います
+    with _write_pool.connection() as conn:
+        # journal_mode=WAL: 書き込みを追記ログに記録する方式。読み込みと書き込みが互いを待たなくなります。
+        # この設定はデータベースファイルに保存され、以降の全ての接続に引き継がれます。
+        conn.execute("PRAGMA journal_mode=WAL")
+        # SQLを実行してテーブルを作成
+        # IF NOT EXISTS: すでにテーブルがある場合は何もしない
+        # id: 一意な識別子 (PRIMARY KEY)
+        # category: 記憶の種類（属性、目標、記憶、要望）
+        # content: 記憶の内容
+        # created_at: 作成日時（デフォルトで現在時刻を入れる）
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS memories (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                category TEXT NOT NULL, -- attribute, goal, memory, request
+                content TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # インデックスの作成
+        # カテゴリごとに新しい順で並べる検索（get_memories_bucketed など）を、表全体を並べ替えずに行えるようにします。
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_mem_cat_created ON memories(category, created_at DESC)
+        ''')
+        # カテゴリを指定しない全件取得（get_memories）の ORDER BY created_at DESC も、
+        # 並べ替えをせずにインデックスを順に読むだけで済むようにします。
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_memories_created ON memories(created_at DESC)
+        ''')
+        # LLMの応答キャッシュ用のテーブル
+        # key: プロンプトなどから作ったハッシュ値 / resp: LLMの応答テキスト / ts: 保存（最終利用）時刻（UNIX時間）
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key BLOB PRIMARY KEY,
+                resp TEXT NOT NULL,
+                ts INTEGER NOT NULL
+            )
+        ''')
+    # 起動時に期限切れのキャッシュを掃除します
+    sweep_llm_cache()
 
 # 記憶を追加する関数
 # INSERT文を使ってデータを挿入します。
+# 戻り値: 追加した記憶の辞書（id と created_at はデータベースが決めた値）
 def add_memory(category, content):
-    conn = get_db_connection()
-    c = conn.cursor()
-    # SQLインジェクションを防ぐため、プレースホルダー（?）を使用します。
-    # 第2引数のタプル (category, content) が ? に代入されます。
-    c.execute('INSERT INTO memories (category, content) VALUES (?, ?)', (category, content))
-    conn.commit()
-    conn.close()
+    with get_write_connection() as conn:
+        # SQLインジェクションを防ぐため、プレースホルダー（?）を使用します。
+        # 第2引数のタプル (category, content) が ? に代入されます。
+        # RETURNING の結果は、COMMIT する前に受け取っておく必要があります。
+        row = conn.execute(_SQL_INSERT_RETURNING, (category, content)).fetchone()
+    _bump()
+    return dict(zip(_MEMORY_KEYS, row))
+
+# 複数の記憶をまとめて追加する関数
+# items: (category, content) のタプルのリスト
+# add_memory() を件数分呼ぶと、1件ごとにトランザクションの確定（ディスクへの書き込み）が発生します。
+# get_write_connection() の1つのトランザクションにまとめ、同じINSERT文を executemany で繰り返し実行します。
+def add_memories_bulk(items):
+    if not items:
+        return
+    with get_write_connection() as conn:
+        conn.executemany(_SQL_INSERT, items)
+    _bump()
 
 # 記憶を取得する関数
 # SELECT文を使ってデータを取得します。
 def get_memories(category=None):
-    conn = get_db_connection()
-    c = conn.cursor()
-    if category:
-        # カテゴリ指定がある場合
-        c.execute('SELECT * FROM memories WHERE category = ? ORDER BY created_at DESC', (category,))
-    else:
-        # 全ての記憶を取得する場合
-        c.execute('SELECT * FROM memories ORDER BY created_at DESC')
-    rows = c.fetchall()
-    conn.close()
-    # sqlite3.RowオブジェクトをPythonの辞書に変換して返します
-    return [dict(row) for row in rows]
+    # キャッシュがあれば、SQLを実行せずにそこから返します
+    rows, version = _cache_get("all", category)
+    if rows is None:
+        with get_read_connection() as conn:
+            if category:
+                # カテゴリ指定がある場合はWHERE句で絞り込みます
+                cursor = conn.execute(_SQL_SELECT_BY_CATEGORY, (category,))
+            else:
+                # 全ての記憶を取得
+                cursor = conn.execute(_SQL_SELECT_ALL)
+            # タプルの結果をPythonの辞書に変換します
+            rows = _to_dicts(cursor.fetchall())
+        _cache_put("all", category, version, rows)
+    # 呼び出し側でリストを変更してもキャッシュが壊れないように、コピーを返します
+    return list(rows)
+
+# 記憶を batch_size 件ずつのリストにして順番に取り出す関数（ジェネレーター）
+# get_memories() は全件をリストにしてから返しますが、こちらは cursor.fetchmany で少しずつ読み込みながら yield します。
+# 記憶が多くても、メモリ上に置くのは読み込み中の batch_size 件だけで済みます（APIのストリーミング応答で使用）。
+# limit: 取得する最大件数（None なら全件） / offset: 先頭から飛ばす件数（ページ分割に使います）
+# 取り出し終わるまで読み込み用の接続を1つ借りたままになります。
+def get_memories_iter(category=None, limit=None, offset=0, batch_size=200):
+    limit = -1 if limit is None else limit
+    with get_read_connection() as conn:
+        if category:
+            cursor = conn.execute(_SQL_SELECT_PAGE_BY_CATEGORY, (category, limit, offset))
+        else:
+            cursor = conn.execute(_SQL_SELECT_PAGE, (limit, offset))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield _to_dicts(rows)
+
+# カテゴリごとに新しい順で上位k件の記憶を、カテゴリ別に分けて取得する関数
+# 戻り値: {"attribute": [...], "goal": [...], ...} のようなカテゴリ名 → 記憶のリスト の辞書
+# チャットのプロンプトに全ての記憶を埋め込むと、記憶が増えるほどトークン数が増え続けます。
+# カテゴリごとに件数の上限を設けることで、DBの大きさに関係なくプロンプトの長さを一定以下に保ちます。
+# ROW_NUMBER() OVER (PARTITION BY ...): カテゴリごとに新しい順の連番を振るウィンドウ関数です。
+# これを使うと、カテゴリの数だけSQLを発行せずに1回のクエリで済みます。
+# SQLの ORDER BY category で同じカテゴリの行を連続させておけば、
+# itertools.groupby で前から順に区切るだけで、1件ずつカテゴリを比較せずに振り分けられます。
+def get_memories_bucketed(k_per_cat=10):
+    buckets, version = _cache_get("bucketed", k_per_cat)
+    if buckets is None:
+        with get_read_connection() as conn:
+            cursor = conn.execute(_SQL_TOPK_BY_CATEGORY, (k_per_cat,))
+            buckets = {
+                category: _to_dicts(rows)
+                for category, rows in groupby(cursor.fetchall(), key=itemgetter(1)) # 1: category の列
+            }
+        _cache_put("bucketed", k_per_cat, version, buckets)
+    # get_memories() と同じく、呼び出し側で変更してもキャッシュが壊れないように、辞書とリストのコピーを返します
+    return {category: list(rows) for category, rows in buckets.items()}
 
 # 記憶を削除する関数
 # DELETE文を使ってデータを削除します。
+# 戻り値: 削除した記憶のID（該当する記憶がなかった場合は None）
 def delete_memory(memory_id):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('DELETE FROM memories WHERE id = ?', (memory_id,))
-    conn.commit()
-    conn.close()
+    with get_write_connection() as conn:
+        row = conn.execute(_SQL_DELETE_RETURNING, (memory_id,)).fetchone()
+    # 該当する記憶がなく何も変わらなかった場合は、キャッシュをそのまま使い続けます
+    if row:
+        _bump()
+    return row[0] if row else None
 
 # 記憶を更新する関数
 # UPDATE文を使ってデータを書き換えます。
+# 戻り値: 更新後の記憶の辞書（該当する記憶がなかった場合は None）
 def update_memory(memory_id, content, category):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('UPDATE memories SET content = ?, category = ? WHERE id = ?', (content, category, memory_id))
-    conn.commit()
-    conn.close()
+    with get_write_connection() as conn:
+        row = conn.execute(_SQL_UPDATE_RETURNING, (content, category, memory_id)).fetchone()
+    if row:
+        _bump()
+    return dict(zip(_MEMORY_KEYS, row)) if row else None
+
+# まとめて実行する操作の種類と、対応するSQL
+# add: (category, content) / delete: (id,) / update: (content, category, id) の順で値を渡します。
+_BATCH_SQL = {
+    "add": _SQL_INSERT,
+    "delete": _SQL_DELETE,
+    "update": _SQL_UPDATE,
+}
+
+# 複数の追加・削除・更新を1回の処理でまとめて実行する関数（圧縮機能などで使用）
+# ops: ("add", (category, content)) のような (操作の種類, SQLに渡す値) の組のリスト
+# 1件ずつ自動コミットすると、その回数だけディスクへの書き込み確定が発生します。
+# get_write_connection() で1つのトランザクションにすることで、確定を1回で済ませます。
+# さらに同じ種類の操作をまとめて executemany で実行し、同じSQL文を1回の呼び出しで繰り返し実行します。
+# 操作の種類ごとにまとめるため、種類をまたいだ実行順（例: 追加と削除の順番）は保証されません。
+# 同じ記憶に対して種類の違う操作を同時に渡さないでください。
+# 途中で失敗した場合は ROLLBACK され、全ての操作がなかったことになります。
+def batch_apply(ops):
+    if not ops:
+        return
+    # 操作の種類ごとに、SQLに渡す値をまとめます（最初に現れた種類の順で実行します）
+    grouped = {}
+    for kind, params in ops:
+        grouped.setdefault(kind, []).append(params)
+    with get_write_connection() as conn:
+        for kind, params_list in grouped.items():
+            conn.executemany(_BATCH_SQL[kind], params_list)
+    _bump()
 
 # 全ての記憶を削除する関数（圧縮機能などで使用）
 # 十分に注意して使用する必要があります。
 def delete_all_memories():
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('DELETE FROM memories')
-    # IDの自動採番（AUTOINCREMENT）をリセットする場合（任意）
-    # c.execute('DELETE FROM sqlite_sequence WHERE name="memories"')
-    conn.commit()
-    conn.close()
+    with get_write_connection() as conn:
+        conn.execute(_SQL_DELETE_ALL)
+        # IDの自動採番（AUTOINCREMENT）をリセットする場合（任意）
+        # conn.execute('DELETE FROM sqlite_sequence WHERE name="memories"')
+    _bump()
+
+# LLMの応答キャッシュを取得する関数
+# 有効期限内の応答があればそのテキストを、なければ None を返します。
+# 使われた応答は最終利用時刻を更新し、よく使う応答ほど長く残るようにします。
+def get_llm_cache(key):
+    now = int(time.time())
+    with get_read_connection() as conn:
+        row = conn.execute(_SQL_LLM_CACHE_GET, (key, now - LLM_CACHE_TTL)).fetchone()
+    if row is None:
+        return None
+    with get_write_connection() as conn:
+        conn.execute(_SQL_LLM_CACHE_TOUCH, (now, key))
+    return row[0]
+
+# LLMの応答キャッシュを保存する関数
+# INSERT OR REPLACE: 同じキーがすでにあれば上書きします。
+def put_llm_cache(key, resp):
+    with get_write_connection() as conn:
+        conn.execute(_SQL_LLM_CACHE_PUT, (key, resp, int(time.time())))
+
+# 期限切れのLLM応答キャッシュを削除する関数
+def sweep_llm_cache():
+    with get_write_connection() as conn:
+        conn.execute(_SQL_LLM_CACHE_SWEEP, (int(time.time()) - LLM_CACHE_TTL,))
@@ -1,26 +1,59 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse, JSONResponse
 # Pydantic: データのバリデーション（検証）や設定管理を行うライブラリ
 # 型ヒントを使って、APIが受け取るデータの形式を定義します。
 from pydantic import BaseModel
 from typing import List, Optional
+from contextlib import asynccontextmanager
 import os
+# anyio: FastAPI（Starlette）が内部で使っている非同期ライブラリ。
+# to_thread.run_sync で、THREAD_LIMIT の上限が効くスレッドプールを使って処理を別スレッドで実行します。
+from anyio import to_thread
+# orjson: 高速なJSONライブラリ。APIの応答やストリーミングで送るデータの変換に使用します。
+import orjson
 # 自作のモジュールをインポート
-from database import init_db, get_memories, add_memory, delete_memory, update_memory
-from ai_engine import AIEngine
+from database import init_db, close_db, get_memories_iter, add_memory, delete_memory, update_memory
+from ai_engine import AIEngine, close_client
+
+# スレッドプールで同時に実行できる処理の数（anyio の初期値は40）
+# データベースの読み書き（to_thread.run_sync）と、Starlette のファイル読み込みやストリーミングが、
+# この上限を共有して別スレッドで実行されます。
+THREAD_LIMIT = 64
+
+# orjson でJSONに変換するレスポンスクラス
+# 標準の JSONResponse は Python標準の json モジュールで変換しますが、orjson はC言語で実装されているため高速です。
+# （FastAPIの ORJSONResponse は非推奨になったため、同じ働きのクラスをここで定義しています）
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+# アプリケーションのライフサイクル（起動〜終了）を管理する関数
+# yield より前が起動時、yield より後が終了時に実行されます。
+# 起動時に1回だけデータベースとAIエンジンを初期化します（モジュールを読み込んだだけでは初期化されません）。
+# 終了時に、会話分析のバックグラウンドワーカーを止め、AIエンジンが使い回しているHTTPクライアントの接続と、
+# データベースのコネクションプールの接続を閉じます。
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # スレッドプールの同時実行数の上限を設定します
+    to_thread.current_default_thread_limiter().total_tokens = THREAD_LIMIT
+    # データベースの初期化
+    # テーブルが存在しなければ作成します。
+    init_db()
+    # AIエンジンの初期化
+    # 会話の履歴管理やLLMとの通信を行うクラスのインスタンスを作成し、app.state に保存します。
+    # 各エンドポイントは request.app.state.ai_engine から取り出して使います。
+    # （テストでは app.state.ai_engine を差し替えるだけで、別のエンジンを使えます）
+    app.state.ai_engine = AIEngine()
+    yield
+    await app.state.ai_engine.shutdown()
+    await close_client()
+    close_db()
 
 # アプリケーションのインスタンスを作成
 # これがWebサーバーの本体になります。
-app = FastAPI(title="AI Secretary")
-
-# データベースの初期化
-# アプリケーション起動時にテーブルが存在しなければ作成します。
-init_db()
-
-# AIエンジンの初期化
-# 会話の履歴管理やLLMとの通信を行うクラスのインスタンスを作成します。
-ai_engine = AIEngine()
+# default_response_class: 各エンドポイントの戻り値を、orjson でJSONに変換して返します。
+app = FastAPI(title="AI Secretary", lifespan=lifespan, default_response_class=FastJSONResponse)
 
 # Staticファイルのマウント
 # "/static" というURLで、"static" フォルダ内のファイル（CSS, JS, 画像など）にアクセスできるようにします。
@@ -49,10 +82,11 @@ class MemoryUpdate(BaseModel):
 # ルーティングの定義
 # @app.get("/") は、ルートURL（http://localhost:8000/）へのGETアクセスに対する処理を定義します。
 # async def: 非同期関数として定義。重い処理（AI応答など）の実行中に、他のリクエストをブロックせずに受け付けられます。
-@app.get("/")
+# cache-control: ブラウザに5分間（300秒）HTMLを保存させ、その間は再読み込みでもサーバーに取りに来ないようにします。
+@app.get("/", response_class=FileResponse)
 async def read_root():
     # HTMLファイルをそのまま返します。ブラウザはこれを受け取って表示します。
-    return FileResponse("static/index.html")
+    return FileResponse("static/index.html", headers={"cache-control": "public, max-age=300"})
 
 @app.get("/admin")
 async def read_admin():
@@ -60,49 +94,87 @@ async def read_admin():
 
 # AIとのチャット用エンドポイント
 # POSTメソッドを使用します（データを送信して処理させるため）。
-# response_modelを指定することで、返却値の形式を保証し、自動的にドキュメント生成にも使われます。
-@app.post("/api/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+# 受け取るデータの検証にはPydanticモデル（ChatRequest）を使いますが、返すデータは毎回検証し直さずに、
+# ChatResponse と同じ形の辞書をそのままJSONにして返します（チャットのたびにモデルを作る処理を省きます）。
+@app.post("/api/chat")
+# http_request: リクエスト全体の情報。ここから app.state に保存したAIエンジンを取り出します。
+async def chat(request: ChatRequest, http_request: Request):
     # ai_engine.chatメソッドを呼び出して、入力に対する応答を生成
     # awaitを使うことで、AIの応答待ちの間、CPUを解放します。
+    ai_engine = http_request.app.state.ai_engine
     result = await ai_engine.chat(request.message, request.test_mode)
-    return ChatResponse(
-        response=result["response"],
-        debug_info=result.get("debug_info")
-    )
+    return FastJSONResponse({
+        "response": result["response"],
+        "debug_info": result.get("debug_info")
+    })
+
+# AIとのチャット用エンドポイント（ストリーミング版）
+# AIの応答を、生成された文字から順に1行ずつのJSON（NDJSON）として返します。
+# 画面側は最初の文字が届いた時点から表示を始められます。
+@app.post("/api/chat/stream")
+async def chat_stream(request: ChatRequest, http_request: Request):
+    ai_engine = http_request.app.state.ai_engine
+    # ai_engine.chat_stream が yield する辞書を、1行ずつのJSON（バイト列）に変換して送る関数
+    async def ndjson():
+        async for event in ai_engine.chat_stream(request.message, request.test_mode):
+            yield orjson.dumps(event) + b"\n"
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+# ストリーミングで送るときに、1回の送信にまとめる記憶の件数
+STREAM_BATCH_SIZE = 200
+
+# 記憶のまとまり（リスト）を、JSON配列のバイト列として少しずつ送り出す関数（ジェネレーター）
+# "[" → 1つ目のまとまり → "," → 2つ目のまとまり … → "]" の順に yield するので、
+# 全件をまとめたJSON文字列を作らずに済みます。
+# 通常の関数（def）のジェネレーターは、StreamingResponse が1回の yield ごとにスレッドプールで実行します。
+# 1件ごとに yield するとその切り替えが件数分発生するので、STREAM_BATCH_SIZE 件ずつまとめて変換して送ります。
+# SQLiteの読み込みもこの中で行われるため、イベントループが止まることはありません。
+def _stream_json(batches):
+    prefix = b"["
+    for batch in batches:
+        yield prefix + b",".join(orjson.dumps(row) for row in batch)
+        prefix = b","
+    yield b"[]" if prefix == b"[" else b"]"
 
 # 記憶データの取得用API
 # クエリパラメータ category を受け取ります（例: /api/memories?category=goal）
 # Optional[str] = None とすることで、categoryは必須ではなくなります。
+# limit / offset でページ分割もできます（例: /api/memories?limit=50&offset=100）。
+# 全件をリストにしてからJSONに変換するのではなく、データベースから STREAM_BATCH_SIZE 件ずつ読み込んだ順に
+# ストリーミングで返します。記憶がいくら増えても、メモリ上に置くのは1回分の件数だけです。
 @app.get("/api/memories")
-async def get_all_memories(category: Optional[str] = None):
-    return get_memories(category)
+async def get_all_memories(category: Optional[str] = None, limit: Optional[int] = None, offset: int = 0):
+    batches = get_memories_iter(category, limit, offset, STREAM_BATCH_SIZE)
+    return StreamingResponse(_stream_json(batches), media_type="application/json")
 
 # 記憶の追加用API
+# 追加した記憶（idや作成日時を含む）をそのまま返すので、画面側で読み直す必要はありません。
 @app.post("/api/memories")
 async def create_memory(item: MemoryItem):
-    add_memory(item.category, item.content)
-    return {"status": "success"}
+    return await to_thread.run_sync(add_memory, item.category, item.content)
 
 # 記憶の更新用API
 # URLパスの一部（{memory_id}）を変数として受け取ります。
+# 更新後の記憶をそのまま返します。指定したIDの記憶がなければ 404 エラーを返します。
 @app.put("/api/memories/{memory_id}")
 async def update_memory_item(memory_id: int, item: MemoryUpdate):
-    update_memory(memory_id, item.content, item.category)
-    return {"status": "success"}
+    memory = await to_thread.run_sync(update_memory, memory_id, item.content, item.category)
+    if memory is None:
+        raise HTTPException(status_code=404, detail="Memory not found")
+    return memory
 
 # 記憶の削除用API
 @app.delete("/api/memories/{memory_id}")
 async def delete_memory_item(memory_id: int):
-    delete_memory(memory_id)
+    await to_thread.run_sync(delete_memory, memory_id)
     return {"status": "success"}
 
 # 記憶の圧縮実行API
 # 管理画面などから手動で呼び出します。
 # ストリーミングレスポンスを返します。
 @app.post("/api/memories/compress")
-async def compress_memories_endpoint():
-    return StreamingResponse(ai_engine.compress_memories_stream(), media_type="application/x-ndjson")
+async def compress_memories_endpoint(request: Request):
+    return StreamingResponse(request.app.state.ai_engine.compress_memories_stream(), media_type="application/x-ndjson")
 
 # このファイルが直接実行された場合（python main.py）、サーバーを起動します。
 # uvicornは、FastAPIを動かすための高速なASGIサーバーです。
@@ -1,58 +1,93 @@
-from datetime import datetime
-from database import get_memories, add_memory, delete_memory, update_memory, delete_all_memories
-import json
+from database import cache_version, get_memories, get_memories_bucketed, add_memory, add_memories_bulk, delete_memory, update_memory, delete_all_memories, batch_apply
+
+# チャットのコンテキストとして読み込む記憶の、カテゴリごとの最大件数
+# 各カテゴリの新しい記憶からこの件数だけをLLMに渡します。
+ACTIVE_MEMORIES_PER_CATEGORY = 10
+
+# カテゴリ名 → read_resource("memories://active") の結果で使うキー名 の対応表
+# ここにないカテゴリは「その他の記憶」として "memories" に入れます。
+_BUCKET = {
+    "attribute": "attributes",
+    "goal": "goals",
+    "request": "requests",
+    "memory": "memories",
+}
 
 # MCP (Model Context Protocol) の概念を模倣したサーバークラス
 # 実際のMCPはJSON-RPCベースのプロトコルですが、ここではアプリ内クラスとして
 # 「リソース(Resource)」と「ツール(Tool)」のインターフェースを提供します。
 
+# 辞書のリスト [{"category": ..., "content": ...}, ...] を、add_memories_bulk() に渡すタプルのリストに変換する関数
+def _bulk_items(items):
+    return [(item["category"], item["content"]) for item in items]
+
 class MemoryMCPServer:
     def __init__(self):
         self.name = "Memory Assistant MCP Server"
+        # memories://active の整形結果のキャッシュ (バージョン, 整形済みの辞書)
+        # 記憶が書き換わるまでは同じ結果になるので、カテゴリ分けの処理も省略します。
+        self._active_cache = (None, None)
+        # リソースのURI → 取得する関数 の対応表
+        # if/elif で順番に比較する代わりに、1回の辞書引きで処理を選びます。
+        self._resources = {
+            "memories://active": self._read_active,
+            "memories://all": get_memories,
+        }
+        # ツール名 → 実行する関数 の対応表（どの関数も引数の辞書を1つ受け取ります）
+        self._tools = {
+            "add_memory": lambda a: add_memory(a["category"], a["content"]),
+            "delete_memory": lambda a: delete_memory(a["id"]),
+            "update_memory": lambda a: update_memory(a["id"], a["content"], a["category"]),
+            "bulk_add": lambda a: add_memories_bulk(_bulk_items(a["items"])), # 複数の記憶をまとめて追加
+            "batch_apply": lambda a: batch_apply(a["ops"]), # 複数の操作をまとめて実行（圧縮処理用）
+            "delete_all": lambda a: delete_all_memories(), # 管理者用
+        }
     
     # --- Resources (リソース) ---
     # コンテキストとしてLLMに提供するデータを取得します。
-    # uri: memories://active (現在のアクティブな記憶)
+    # uri: memories://active (現在のアクティブな記憶。カテゴリごとに新しいものから上位のみ)
+    #      memories://all (全ての記憶。memories://all で始まるURIは全てこれとして扱います)
     def read_resource(self, uri: str):
-        if uri == "memories://active":
-            memories = get_memories()
-            # カテゴリごとに整形
-            formatted = {
-                "attributes": [],
-                "goals": [],
-                "requests": [],
-                "memories": []
-            }
-            for m in memories:
-                if m['category'] == 'attribute':
-                    formatted["attributes"].append(m)
-                elif m['category'] == 'goal':
-                    formatted["goals"].append(m)
-                elif m['category'] == 'request':
-                    formatted["requests"].append(m)
-                else:
-                    formatted["memories"].append(m)
-            return formatted
-        
-        elif uri.startswith("memories://all"):
-             return get_memories()
-
-        raise ValueError(f"Unknown resource: {uri}")
+        fn = self._resources.get(uri)
+        if fn is None and uri.startswith("memories://all"):
+            fn = self._resources["memories://all"]
+        if fn is None:
+            raise ValueError(f"Unknown resource: {uri}")
+        return fn()
+
+    # memories://active の内容を作るメソッド
+    def _read_active(self):
+        # 整形前にバージョンを控えておき、キャッシュが同じバージョンのものならそのまま返します
+        version = cache_version()
+        cached_version, cached = self._active_cache
+        if cached_version == version:
+            return cached
+        # DB側でカテゴリごとに分けた結果を受け取り、カテゴリ単位でまとめて振り分けます
+        buckets = get_memories_bucketed(ACTIVE_MEMORIES_PER_CATEGORY)
+        formatted = {
+            "attributes": [],
+            "goals": [],
+            "requests": [],
+            "memories": []
+        }
+        for category, memories in buckets.items():
+            formatted[_BUCKET.get(category, "memories")].extend(memories)
+        self._active_cache = (version, formatted)
+        return formatted
 
     # --- Tools (ツール) ---
     # LLMが実行できる機能を提供します（今回は圧縮ロジックなどで使用される想定）
     
-    def call_tool(self, name: str, arguments: dict):
-        if name == "add_memory":
-            return add_memory(arguments["category"], arguments["content"])
-        elif name == "delete_memory":
-            return delete_memory(arguments["id"])
-        elif name == "update_memory":
-            return update_memory(arguments["id"], arguments["content"], arguments["category"])
-        elif name == "delete_all": # 管理者用
-             return delete_all_memories()
-        
-        raise ValueError(f"Unknown tool: {name}")
+    # arguments: 通常は引数の辞書。add_memory / bulk_add では、
+    #            {"category": ..., "content": ...} の辞書のリストを渡すとまとめて追加します。
+    def call_tool(self, name: str, arguments):
+        # 引数がリストの場合は、1件ずつではなくまとめて追加する処理に回します
+        if isinstance(arguments, list) and name in ("add_memory", "bulk_add"):
+            return add_memories_bulk(_bulk_items(arguments))
+        fn = self._tools.get(name)
+        if fn is None:
+            raise ValueError(f"Unknown tool: {name}")
+        return fn(arguments)
 
 # シングルトンとしてエクスポート
 memory_mcp_server = MemoryMCPServer()